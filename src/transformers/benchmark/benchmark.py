@@ -19,17 +19,26 @@
 
 
 import logging
-import timeit
+import statistics
+import time
+from contextlib import ExitStack
+from functools import partial
 
 from transformers import (
     MODEL_MAPPING,
     MODEL_WITH_LM_HEAD_MAPPING,
     PretrainedConfig,
     is_torch_available,
-    is_torch_tpu_available,
 )
 
-from .benchmark_utils import Benchmark, Memory, measure_peak_memory_cpu, start_memory_tracing, stop_memory_tracing
+from .benchmark_utils import (
+    Benchmark,
+    Memory,
+    measure_peak_memory_cpu,
+    measure_peak_memory_cpu_fast,
+    start_memory_tracing,
+    stop_memory_tracing,
+)
 
 
 if is_torch_available():
@@ -40,16 +49,242 @@ if is_torch_available():
 logger = logging.getLogger(__name__)
 
 
+def _free_gradients(model):
+    # same as `model.zero_grad(set_to_none=True)`, which needs PyTorch >= 1.7
+    for param in model.parameters():
+        param.grad = None
+
+
 class PyTorchBenchmark(Benchmark):
 
     args: PyTorchBenchmarkArguments
     configs: PretrainedConfig
     framework: str = "PyTorch"
 
+    def __init__(self, args: PyTorchBenchmarkArguments = None, configs: PretrainedConfig = None):
+        super().__init__(args, configs)
+        # py3nvml module once initialized, None if not initialized yet and False if initialization failed
+        self._nvml = None
+        # (model name, batch size, sequence length) the torch.compile model was last compiled for
+        self._compiled_shape = None
+
+        if self.args.torch_compile:
+            assert not self.args.torchscript, "torchscript and torch_compile cannot be used at the same time."
+            if not hasattr(torch, "compile"):
+                raise ImportError(
+                    "torch_compile requires PyTorch >= 2.0, but PyTorch {} is installed.".format(torch.__version__)
+                )
+
+    def __del__(self):
+        if getattr(self, "_nvml", None):
+            self._nvml.nvmlShutdown()
+
     @property
     def framework_version(self):
         return torch.__version__
 
+    def _measure_speed(self, func, warmup=10, number=10):
+        assert self.args.stat in ("min", "median"), "Unknown stat {}".format(self.args.stat)
+
+        # warm up to exclude cudnn autotuning, lazy initialization and compilation for tpu and torchscript
+        for _ in range(warmup):
+            func()
+
+        def _timed():
+            if self.is_gpu:
+                torch.cuda.synchronize(self.args.device)
+
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            if self.is_gpu:
+                torch.cuda.synchronize(self.args.device)
+            return (time.perf_counter() - start) / number
+
+        runtimes = [_timed() for _ in range(self.args.repeat)]
+
+        if self.is_tpu and self.args.tpu_print_metrics:
+            import torch_xla.debug.metrics as met
+
+            self.print_fn(met.metrics_report())
+
+        # a large median absolute deviation means the runs are not stable yet, which `min` would hide
+        median = statistics.median(runtimes)
+        mad = statistics.median([abs(runtime - median) for runtime in runtimes])
+        if median > 0 and mad / median > 0.05:
+            logger.warning(
+                "Speed measurements vary by {:.1f}% between runs. Consider increasing `repeat`.".format(
+                    100 * mad / median
+                )
+            )
+
+        if self.args.stat == "median":
+            return median
+        # as written in https://docs.python.org/2/library/timeit.html#timeit.Timer.repeat, min should be taken rather than the average
+        return min(runtimes)
+
+    def _measure_memory(self, func):
+        if self.args.trace_memory_line_by_line:
+            trace = start_memory_tracing("transformers")
+
+        if self.is_gpu:
+            # wait for pending kernels and release blocks cached by previous runs
+            # so that only the memory allocated by `func` is measured
+            torch.cuda.synchronize(self.args.device)
+            torch.cuda.empty_cache()
+            if hasattr(torch.cuda, "reset_peak_memory_stats"):
+                torch.cuda.reset_peak_memory_stats(self.args.device)
+            else:
+                logger.info("Please consider updating PyTorch to version 1.4 to get more accuracy on GPU memory usage")
+                torch.cuda.reset_max_memory_allocated(self.args.device)
+
+            func()
+            torch.cuda.synchronize(self.args.device)
+
+            if self.args.use_nvml_memory:
+                memory = self._measure_nvml_memory()
+            else:
+                memory = Memory(torch.cuda.max_memory_allocated(self.args.device))
+        elif self.is_tpu:
+            raise NotImplementedError(
+                "Memory Benchmarking is currently not implemented for TPU. Please disable memory benchmarking with `args.no_memory=True`"
+            )
+        else:
+            if self.args.trace_memory_line_by_line:
+                memory_bytes = measure_peak_memory_cpu(func)
+            else:
+                memory_bytes = measure_peak_memory_cpu_fast(func)
+            memory = Memory(memory_bytes) if isinstance(memory_bytes, int) else memory_bytes
+
+        if self.args.trace_memory_line_by_line:
+            summary = stop_memory_tracing(trace)
+        else:
+            summary = None
+
+        return memory, summary
+
+    def _measure_nvml_memory(self):
+        # nvml is initialized once and shut down when the benchmark is deleted
+        if self._nvml is False:
+            return Memory(torch.cuda.max_memory_allocated(self.args.device))
+        if self._nvml is None:
+            try:
+                from py3nvml import py3nvml
+
+                py3nvml.nvmlInit()
+            except ImportError:
+                logger.warning(
+                    "py3nvml not installed, we will report the memory allocated by PyTorch instead. "
+                    "Install py3nvml (pip install py3nvml) to measure GPU memory with nvml."
+                )
+                self._nvml = False
+                return Memory(torch.cuda.max_memory_allocated(self.args.device))
+            except (OSError, py3nvml.NVMLError):
+                logger.warning(
+                    "Error while initializing comunication with GPU. "
+                    "We will report the memory allocated by PyTorch instead."
+                )
+                self._nvml = False
+                return Memory(torch.cuda.max_memory_allocated(self.args.device))
+            self._nvml = py3nvml
+
+        handle = self._nvml.nvmlDeviceGetHandleByIndex(self.args.device_idx)
+        meminfo = self._nvml.nvmlDeviceGetMemoryInfo(handle)
+        return Memory(meminfo.used)
+
+    def _get_input_ids(self, batch_size, sequence_length, vocab_size):
+        # random inputs only depend on their shape, so they are shared by all models of a run
+        key = (batch_size, sequence_length, vocab_size, str(self.args.device))
+        if key not in self._input_cache:
+            self._input_cache[key] = torch.randint(
+                vocab_size, (batch_size, sequence_length), dtype=torch.long, device=self.args.device
+            )
+        return self._input_cache[key]
+
+    def _get_model(self, model_name, config, with_lm_head):
+        # the weights don't depend on batch size and sequence length, so the model is only re-built when
+        # it changes. Only one model is kept, a second resident model would be counted in the memory measurements
+        key = (model_name, with_lm_head, self.args.torchscript, self.args.fp16)
+        if key not in self._model_cache:
+            self._model_cache.clear()
+            # compiled models share the parameters of the model they were compiled from
+            self._compiled_model_cache.clear()
+            self._compiled_shape = None
+            model_mapping = MODEL_WITH_LM_HEAD_MAPPING if with_lm_head else MODEL_MAPPING
+            if hasattr(torch.device, "__enter__"):
+                # allocate the parameters directly on the target device instead of copying them (PyTorch >= 2.0)
+                with self.args.device:
+                    model = model_mapping[config.__class__](config)
+            else:
+                model = model_mapping[config.__class__](config)
+            self._model_cache[key] = model.to(self.args.device)
+
+        model = self._model_cache[key]
+        # gradients of previous training runs would otherwise be counted in the memory measurements
+        _free_gradients(model)
+        return model
+
+    def _autocast(self):
+        # autocast is only entered for fp16, so that fp32 runs work with PyTorch versions without amp
+        if not self.args.fp16:
+            return ExitStack()
+        if hasattr(torch, "autocast"):
+            return torch.autocast("cuda", dtype=torch.float16)
+        return torch.cuda.amp.autocast()
+
+    def _jit_compile(self, model_name, model, input_ids):
+        jit_method = self.args.jit_method
+        assert jit_method in ("trace", "script", "auto"), "Unknown jit_method {}".format(jit_method)
+
+        def script():
+            try:
+                return torch.jit.script(model)
+            except Exception as e:
+                # scripting errors (e.g. `NotSupportedError` for `**kwargs` in forward) are not `RuntimeError`s,
+                # they are re-raised as such to report the model as N/A instead of aborting the benchmark
+                raise NotImplementedError("Scripting {} is not supported: {}".format(model_name, e)) from e
+
+        if jit_method == "script":
+            jit_model = script()
+        elif jit_method == "trace":
+            jit_model = torch.jit.trace(model, input_ids)
+        else:
+            try:
+                jit_model = torch.jit.trace(model, input_ids)
+            except Exception:
+                logger.info("Tracing {} failed, falling back to scripting it".format(model_name))
+                jit_model = script()
+
+        if self.args.jit_optimize_for_inference:
+            assert hasattr(
+                torch.jit, "optimize_for_inference"
+            ), "jit_optimize_for_inference requires PyTorch >= 1.10, but found {}".format(torch.__version__)
+            jit_model = torch.jit.optimize_for_inference(jit_model)
+        return jit_model
+
+    def _compile_for_shape(self, func, shape):
+        if shape == self._compiled_shape:
+            return
+
+        from torch._dynamo.utils import counters
+
+        # dynamo recompiles the static-shape model for each new shape and silently falls back to eager execution
+        # once its recompilation limit is reached, so its cache is reset whenever the sweep moves to a new shape
+        torch._dynamo.reset()
+        compiled_graphs = counters["stats"]["unique_graphs"]
+
+        # compile and record the CUDA graphs of "reduce-overhead" mode (done on the first calls)
+        # before measuring, so that compilation is not part of the memory and speed measurements
+        for _ in range(3):
+            func()
+
+        if counters["stats"]["unique_graphs"] == compiled_graphs:
+            logger.warning(
+                "torch.compile did not compile a graph for {} with batch size {} and sequence length {}, "
+                "the model runs in eager mode.".format(*shape)
+            )
+        self._compiled_shape = shape
+
     def train(self, model_name, batch_size, sequence_length, trace_memory=False):
         try:
             config = self.config_dict[model_name]
@@ -57,30 +292,46 @@ class PyTorchBenchmark(Benchmark):
             if self.args.torchscript:
                 config.torchscript = True
 
-            model = MODEL_WITH_LM_HEAD_MAPPING[config.__class__](config)
-            model.to(self.args.device)
+            model = self._get_model(model_name, config, with_lm_head=True)
             model.train()
 
+            if self.args.fp16:
+                logger.info("Running training in Mixed Precision...")
+                assert self.is_gpu, "Mixed precision is possible only for GPU."
+                # weights are kept in fp32, only the loss is scaled to avoid fp16 gradient underflow
+                if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+                    scaler = torch.amp.GradScaler("cuda")
+                else:
+                    scaler = torch.cuda.amp.GradScaler()
+            else:
+                scaler = None
+
             # encoder-decoder has vocab size saved differently
             vocab_size = config.vocab_size if hasattr(config, "vocab_size") else config.encoder.vocab_size
-            input_ids = torch.randint(
-                vocab_size, (batch_size, sequence_length), dtype=torch.long, device=self.args.device
-            )
+            input_ids = self._get_input_ids(batch_size, sequence_length, vocab_size)
 
             if self.args.torchscript:
                 raise NotImplementedError("Training for torchscript is currently not implemented")
+            elif self.args.torch_compile:
+                raise NotImplementedError("Training for torch_compile is currently not implemented")
             else:
                 train_model = model
 
             def compute_loss_and_backprob_encoder():
-                loss = train_model(input_ids, labels=input_ids)[0]
+                _free_gradients(train_model)
+                with self._autocast():
+                    loss = train_model(input_ids, labels=input_ids)[0]
+                if scaler is not None:
+                    loss = scaler.scale(loss)
                 loss.backward()
-                train_model.zero_grad()
 
             def compute_loss_and_backprob_encoder_decoder():
-                loss = train_model(input_ids, decoder_input_ids=input_ids, labels=input_ids)[0]
+                _free_gradients(train_model)
+                with self._autocast():
+                    loss = train_model(input_ids, decoder_input_ids=input_ids, labels=input_ids)[0]
+                if scaler is not None:
+                    loss = scaler.scale(loss)
                 loss.backward()
-                train_model.zero_grad()
 
             _train = (
                 compute_loss_and_backprob_encoder_decoder
@@ -89,66 +340,9 @@ class PyTorchBenchmark(Benchmark):
             )
 
             if trace_memory is True:
-                if self.args.trace_memory_line_by_line:
-                    trace = start_memory_tracing("transformers")
-
-                if self.args.n_gpu > 0:
-                    # gpu
-                    # clear gpu cache
-                    torch.cuda.empty_cache()
-                    if hasattr(torch.cuda, "max_memory_reserved"):
-                        torch.cuda.reset_peak_memory_stats()
-                    else:
-                        logger.info(
-                            "Please consider updating PyTorch to version 1.4 to get more accuracy on GPU memory usage"
-                        )
-                        torch.cuda.reset_max_memory_cached()
-
-                    # calculate loss and do backpropagation
-                    _train()
-                elif not self.args.no_tpu and is_torch_tpu_available():
-                    # tpu
-                    raise NotImplementedError(
-                        "Memory Benchmarking is currently not implemented for TPU. Please disable memory benchmarking with `args.no_memory=True`"
-                    )
-                else:
-                    # cpu
-                    memory_bytes = measure_peak_memory_cpu(_train)
-                    memory = Memory(memory_bytes) if isinstance(memory_bytes, int) else memory_bytes
-
-                if self.args.trace_memory_line_by_line:
-                    summary = stop_memory_tracing(trace)
-                else:
-                    summary = None
-
-                if self.args.n_gpu > 0:
-                    # gpu
-                    if hasattr(torch.cuda, "max_memory_reserved"):
-                        memory = Memory(torch.cuda.max_memory_reserved())
-                    else:
-                        logger.info(
-                            "Please consider updating PyTorch to version 1.4 to get more accuracy on GPU memory usage"
-                        )
-                        memory = Memory(torch.cuda.max_memory_reserved())
-
-                return memory, summary
+                return self._measure_memory(_train)
             else:
-                if (not self.args.no_tpu and is_torch_tpu_available()) or self.args.torchscript:
-                    # run additional 10 times to stabilize compilation for tpu and torchscript
-                    logger.info("Do inference on TPU or torchscript. Running model 5 times to stabilize compilation")
-                    timeit.repeat(
-                        _train, repeat=1, number=5,
-                    )
-
-                # as written in https://docs.python.org/2/library/timeit.html#timeit.Timer.repeat, min should be taken rather than the average
-                runtimes = timeit.repeat(_train, repeat=self.args.repeat, number=10,)
-
-                if not self.args.no_tpu and is_torch_tpu_available() and self.args.tpu_print_metrics:
-                    import torch_xla.debug.metrics as met
-
-                    self.print_fn(met.metrics_report())
-
-                return min(runtimes) / 10.0
+                return self._measure_speed(_train)
         except RuntimeError as e:
             self.print_fn("Doesn't fit on GPU. {}".format(e))
             if trace_memory:
@@ -159,107 +353,67 @@ class PyTorchBenchmark(Benchmark):
     def inference(self, model_name, batch_size, sequence_length, trace_memory=False):
         try:
             config = self.config_dict[model_name]
-            model = None
 
             if self.args.torchscript:
                 config.torchscript = True
 
-            if self.args.with_lm_head:
-                model = MODEL_WITH_LM_HEAD_MAPPING[config.__class__](config)
-            else:
-                model = MODEL_MAPPING[config.__class__](config)
-
+            model = self._get_model(model_name, config, with_lm_head=self.args.with_lm_head)
             model.eval()
-            model.to(self.args.device)
+
+            if self.args.fp16:
+                logger.info("Running inference in Mixed Precision...")
+                assert self.is_gpu, "Mixed precision is possible only for GPU."
 
             # encoder-decoder has vocab size saved differently
             vocab_size = config.vocab_size if hasattr(config, "vocab_size") else config.encoder.vocab_size
 
-            input_ids = torch.randint(
-                vocab_size, (batch_size, sequence_length), dtype=torch.long, device=self.args.device
-            )
+            input_ids = self._get_input_ids(batch_size, sequence_length, vocab_size)
+
+            # inference mode additionally disables view and version counter tracking (PyTorch >= 1.9)
+            no_grad = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
 
             if self.args.torchscript:
-                with torch.no_grad():
+                with no_grad():
                     if config.is_encoder_decoder:
                         raise NotImplementedError("Torchscript is currently not supported for EncoderDecoder models")
                     else:
-                        inference_model = torch.jit.trace(model, input_ids)
+                        # compile once per input shape, the memory and speed measurements share the compiled model.
+                        # The sweep never returns to a previous shape, so only the current compiled model is kept
+                        key = (model_name, batch_size, sequence_length)
+                        if key not in self._compiled_model_cache:
+                            self._compiled_model_cache.clear()
+                            self._compiled_model_cache[key] = self._jit_compile(model_name, model, input_ids)
+                        inference_model = self._compiled_model_cache[key]
+            elif self.args.torch_compile:
+                # the model is wrapped once, dynamo compiles it lazily for each input shape (see `_compile_for_shape`)
+                key = (model_name,)
+                if key not in self._compiled_model_cache:
+                    self._compiled_model_cache.clear()
+                    self._compiled_model_cache[key] = torch.compile(
+                        model, mode=self.args.torch_compile_mode, fullgraph=False, dynamic=False
+                    )
+                inference_model = self._compiled_model_cache[key]
             else:
                 inference_model = model
 
-            def encoder_decoder_forward():
-                with torch.no_grad():
-                    inference_model(input_ids, decoder_input_ids=input_ids)
-
-            def encoder_forward():
-                with torch.no_grad():
-                    inference_model(input_ids)
-
-            _forward = encoder_decoder_forward if config.is_encoder_decoder else encoder_forward
-
-            if trace_memory is True:
-                if self.args.trace_memory_line_by_line:
-                    trace = start_memory_tracing("transformers")
-
-                if self.args.n_gpu > 0:
-                    # gpu
-                    # clear gpu cache
-                    torch.cuda.empty_cache()
-                    if hasattr(torch.cuda, "max_memory_reserved"):
-                        torch.cuda.reset_peak_memory_stats()
-                    else:
-                        logger.info(
-                            "Please consider updating PyTorch to version 1.4 to get more accuracy on GPU memory usage"
-                        )
-                        torch.cuda.reset_max_memory_cached()
-
-                    # run forward
-                    _forward()
-                elif not self.args.no_tpu and is_torch_tpu_available():
-                    # tpu
-                    raise NotImplementedError(
-                        "Memory Benchmarking is currently not implemented for TPU. Please disable memory benchmarking with `args.no_memory=True`"
-                    )
-                else:
-                    # cpu
-                    memory_bytes = measure_peak_memory_cpu(_forward)
-                    memory = Memory(memory_bytes) if isinstance(memory_bytes, int) else memory_bytes
-
-                if self.args.trace_memory_line_by_line:
-                    summary = stop_memory_tracing(trace)
-                else:
-                    summary = None
-
-                if self.args.n_gpu > 0:
-                    # gpu
-                    if hasattr(torch.cuda, "max_memory_reserved"):
-                        memory = Memory(torch.cuda.max_memory_reserved())
-                    else:
-                        logger.info(
-                            "Please consider updating PyTorch to version 1.4 to get more accuracy on GPU memory usage"
-                        )
-                        memory = Memory(torch.cuda.max_memory_cached())
-
-                return memory, summary
+            # bind the inputs with `partial` rather than in a closure to save a python frame per forward call
+            if config.is_encoder_decoder:
+                _forward = partial(inference_model, input_ids, decoder_input_ids=input_ids)
             else:
+                _forward = partial(inference_model, input_ids)
 
-                if (not self.args.no_tpu and is_torch_tpu_available()) or self.args.torchscript:
-                    # run additional 10 times to stabilize compilation for tpu and torchscript
-                    logger.info("Do inference on TPU or torchscript. Running model 5 times to stabilize compilation")
-                    timeit.repeat(
-                        _forward, repeat=1, number=5,
-                    )
-
-                # as written in https://docs.python.org/2/library/timeit.html#timeit.Timer.repeat, min should be taken rather than the average
-                runtimes = timeit.repeat(_forward, repeat=self.args.repeat, number=10,)
-
-                if not self.args.no_tpu and is_torch_tpu_available() and self.args.tpu_print_metrics:
-                    import torch_xla.debug.metrics as met
+            # the contexts are entered once for all runs, so that their python overhead
+            # is not part of each measured forward call
+            with no_grad(), self._autocast():
+                if self.args.torch_compile:
+                    self._compile_for_shape(_forward, (model_name, batch_size, sequence_length))
 
-                    self.print_fn(met.metrics_report())
-
-                return min(runtimes) / 10.0
+                if trace_memory is True:
+                    return self._measure_memory(_forward)
+                else:
+                    # the jit profiles and optimizes scripted modules over their first runs
+                    warmup = 20 if self.args.torchscript else 10
+                    return self._measure_speed(_forward, warmup=warmup)
 
         except RuntimeError as e:
             self.print_fn("Doesn't fit on GPU. {}".format(e))
@@ -36,8 +36,35 @@ logger = logging.getLogger(__name__)
 class PyTorchBenchmarkArguments(BenchmarkArguments):
     no_cuda: bool = field(default=False, metadata={"help": "Whether to run on available cuda devices"})
     torchscript: bool = field(default=False, metadata={"help": "Trace the models using torchscript"})
+    jit_method: str = field(
+        default="trace",
+        metadata={
+            "help": "How to compile the model if `torchscript` is set: 'trace', 'script' or 'auto' (trace, and script if tracing fails)"
+        },
+    )
+    jit_optimize_for_inference: bool = field(
+        default=False,
+        metadata={"help": "Freeze and optimize torchscript models with `torch.jit.optimize_for_inference`"},
+    )
+    torch_compile: bool = field(
+        default=False,
+        metadata={
+            "help": "Compile the models with `torch.compile` (PyTorch >= 2.0) for inference. Cannot be used with torchscript"
+        },
+    )
+    torch_compile_mode: str = field(
+        default="reduce-overhead", metadata={"help": "Mode passed to `torch.compile` if `torch_compile` is set"}
+    )
     no_tpu: bool = field(default=False, metadata={"help": "Whether to run on available tpu devices"})
-    fp16: bool = field(default=False, metadata={"help": "Use FP16 to accelerate inference."})
+    fp16: bool = field(
+        default=False, metadata={"help": "Use mixed precision (PyTorch amp) for inference and training"}
+    )
+    use_nvml_memory: bool = field(
+        default=False,
+        metadata={
+            "help": "Report device-wide GPU memory used (via py3nvml) instead of the peak memory allocated by PyTorch"
+        },
+    )
     tpu_print_metrics: bool = field(default=False, metadata={"help": "Use FP16 to accelerate inference."})
 
     @cached_property
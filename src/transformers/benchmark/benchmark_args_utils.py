@@ -92,6 +92,10 @@ class BenchmarkArguments:
         metadata={"help": "Log filename used if print statements are saved in log."},
     )
     repeat: int = field(default=3, metadata={"help": "Times an experiment will be run."})
+    stat: str = field(
+        default="min",
+        metadata={"help": "Statistic reported over the repeated runs of a speed measurement: 'min' or 'median'"},
+    )
 
     def to_json_string(self):
         """
@@ -2,14 +2,20 @@ import os
 import tempfile
 import unittest
 from pathlib import Path
+from unittest.mock import patch
 
 from transformers import AutoConfig, is_torch_available
+from transformers.benchmark.benchmark_utils import measure_peak_memory_cpu_fast
 
 from .utils import require_torch
 
 
 if is_torch_available():
+    import torch
     from transformers import (
+        GPT2Config,
+        GPT2LMHeadModel,
+        GPT2Model,
         PyTorchBenchmarkArguments,
         PyTorchBenchmark,
     )
@@ -48,6 +54,132 @@ class BenchmarkTest(unittest.TestCase):
         self.check_results_dict_not_empty(results.time_inference_result)
         self.check_results_dict_not_empty(results.memory_inference_result)
 
+    def test_inference_torchscript_auto_jit_method(self):
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=False,
+            no_inference=False,
+            torchscript=True,
+            jit_method="auto",
+            sequence_lengths=[8],
+            batch_sizes=[1],
+        )
+        benchmark = PyTorchBenchmark(benchmark_args)
+        results = benchmark.run()
+        self.check_results_dict_not_empty(results.time_inference_result)
+        self.check_results_dict_not_empty(results.memory_inference_result)
+
+    def test_inference_torchscript_auto_jit_method_falls_back_to_script(self):
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=False,
+            no_inference=False,
+            torchscript=True,
+            jit_method="auto",
+            sequence_lengths=[8],
+            batch_sizes=[1],
+        )
+        benchmark = PyTorchBenchmark(benchmark_args)
+        with patch("torch.jit.trace", side_effect=RuntimeError("tracing failed")), patch(
+            "torch.jit.script", side_effect=lambda model: model
+        ) as mock_script:
+            results = benchmark.run()
+        # the scripted model is shared by the memory and speed measurements
+        mock_script.assert_called_once()
+        self.assertIsInstance(results.time_inference_result[MODEL_ID]["result"][1][8], float)
+
+    def test_inference_torchscript_script_failure_is_reported(self):
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=False,
+            no_inference=False,
+            torchscript=True,
+            jit_method="script",
+            sequence_lengths=[8],
+            batch_sizes=[1],
+        )
+        benchmark = PyTorchBenchmark(benchmark_args)
+        with patch("torch.jit.script", side_effect=Exception("kwargs are not supported")):
+            results = benchmark.run()
+        self.assertEqual(results.time_inference_result[MODEL_ID]["result"][1][8], "N/A")
+        self.assertEqual(results.memory_inference_result[MODEL_ID]["result"][1][8], "N/A")
+
+    def test_inference_torch_compile(self):
+        if not hasattr(torch, "compile"):
+            self.skipTest("torch.compile requires PyTorch >= 2.0")
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=False,
+            no_inference=False,
+            torch_compile=True,
+            sequence_lengths=[8, 16],
+            batch_sizes=[1],
+        )
+        benchmark = PyTorchBenchmark(benchmark_args)
+
+        from torch._dynamo.eval_frame import OptimizedModule
+        from torch._dynamo.utils import counters
+
+        # record the measured model and the graphs compiled during each memory measurement
+        measured_models = []
+        graphs_compiled_during_measurement = []
+        measure_memory = benchmark._measure_memory
+
+        def recording_measure_memory(func):
+            measured_models.append(func.func)
+            compiled_graphs = counters["stats"]["unique_graphs"]
+            result = measure_memory(func)
+            graphs_compiled_during_measurement.append(counters["stats"]["unique_graphs"] - compiled_graphs)
+            return result
+
+        with patch.object(benchmark, "_measure_memory", recording_measure_memory):
+            results = benchmark.run()
+        self.check_results_dict_not_empty(results.time_inference_result)
+        self.check_results_dict_not_empty(results.memory_inference_result)
+        self.assertEqual(len(measured_models), 2)
+        for model in measured_models:
+            self.assertIsInstance(model, OptimizedModule)
+        self.assertGreater(counters["stats"]["unique_graphs"], 0)
+        # compilation happens before measuring and is not part of the memory results
+        self.assertListEqual(graphs_compiled_during_measurement, [0, 0])
+
+    def test_inference_median_stat(self):
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=False,
+            no_inference=False,
+            no_memory=True,
+            stat="median",
+            sequence_lengths=[8],
+            batch_sizes=[1],
+        )
+        benchmark = PyTorchBenchmark(benchmark_args)
+        results = benchmark.run()
+        self.check_results_dict_not_empty(results.time_inference_result)
+
+    def test_measure_speed_stat(self):
+        def measure_speed(stat, timestamps):
+            benchmark_args = PyTorchBenchmarkArguments(models=["gpt2"], no_cuda=True, repeat=3, stat=stat)
+            benchmark = PyTorchBenchmark(benchmark_args, configs=[GPT2Config()])
+            # one (start, end) pair of timestamps per repeat, each timing 10 calls
+            with patch("transformers.benchmark.benchmark.time.perf_counter", side_effect=timestamps):
+                return benchmark._measure_speed(lambda: None)
+
+        stable_timestamps = [0.0, 10.0, 0.0, 10.1, 0.0, 10.2]
+        self.assertAlmostEqual(measure_speed("min", stable_timestamps), 1.0)
+        self.assertAlmostEqual(measure_speed("median", stable_timestamps), 1.01)
+
+        # runtimes of 1s, 2s and 3s have a median absolute deviation of 50%
+        noisy_timestamps = [0.0, 10.0, 0.0, 20.0, 0.0, 30.0]
+        with self.assertLogs("transformers.benchmark.benchmark", level="WARNING") as logs:
+            self.assertAlmostEqual(measure_speed("median", noisy_timestamps), 2.0)
+        self.assertIn("vary by 50.0%", logs.output[0])
+
     def test_train_no_configs(self):
         MODEL_ID = "sshleifer/tiny-gpt2"
         benchmark_args = PyTorchBenchmarkArguments(
@@ -118,6 +250,65 @@ class BenchmarkTest(unittest.TestCase):
         self.check_results_dict_not_empty(results.time_train_result)
         self.check_results_dict_not_empty(results.memory_train_result)
 
+    def test_model_built_once_per_model_name(self):
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        config = AutoConfig.from_pretrained(MODEL_ID)
+        built_models = []
+
+        def counting(model_class):
+            def build(config):
+                built_models.append(model_class)
+                return model_class(config)
+
+            return build
+
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID], training=True, no_inference=False, sequence_lengths=[8, 16], batch_sizes=[1, 2]
+        )
+        benchmark = PyTorchBenchmark(benchmark_args, configs=[config])
+
+        # record the models held by the benchmark during each memory measurement
+        resident_models = []
+        measure_memory = benchmark._measure_memory
+
+        def recording_measure_memory(func):
+            resident_models.append([type(model) for model in benchmark._model_cache.values()])
+            return measure_memory(func)
+
+        with patch("transformers.benchmark.benchmark.MODEL_MAPPING", {GPT2Config: counting(GPT2Model)}), patch(
+            "transformers.benchmark.benchmark.MODEL_WITH_LM_HEAD_MAPPING", {GPT2Config: counting(GPT2LMHeadModel)}
+        ), patch.object(benchmark, "_measure_memory", recording_measure_memory):
+            results = benchmark.run()
+        self.check_results_dict_not_empty(results.time_inference_result)
+        self.check_results_dict_not_empty(results.time_train_result)
+        self.assertListEqual(built_models, [GPT2Model, GPT2LMHeadModel])
+        # only the measured model is resident, so no cell counts the weights of the other model
+        self.assertListEqual(resident_models, 4 * [[GPT2Model]] + 4 * [[GPT2LMHeadModel]])
+
+    def test_train_speed_measured_with_train(self):
+        class RecordingBenchmark(PyTorchBenchmark):
+            def train(self, model_name, batch_size, sequence_length, trace_memory=False):
+                return ("train", None) if trace_memory else "train"
+
+            def inference(self, model_name, batch_size, sequence_length, trace_memory=False):
+                return ("inference", None) if trace_memory else "inference"
+
+        MODEL_ID = "sshleifer/tiny-gpt2"
+        benchmark_args = PyTorchBenchmarkArguments(
+            models=[MODEL_ID],
+            training=True,
+            no_inference=False,
+            no_env_print=True,
+            sequence_lengths=[8],
+            batch_sizes=[1],
+        )
+        benchmark = RecordingBenchmark(benchmark_args, configs=[GPT2Config()])
+        results = benchmark.run()
+        self.assertEqual(results.time_train_result[MODEL_ID]["result"][1][8], "train")
+        self.assertEqual(results.memory_train_result[MODEL_ID]["result"][1][8], "train")
+        self.assertEqual(results.time_inference_result[MODEL_ID]["result"][1][8], "inference")
+        self.assertEqual(results.memory_inference_result[MODEL_ID]["result"][1][8], "inference")
+
     def test_save_csv_files(self):
         MODEL_ID = "sshleifer/tiny-gpt2"
         with tempfile.TemporaryDirectory() as tmp_dir:
@@ -167,3 +358,28 @@ class BenchmarkTest(unittest.TestCase):
             _check_summary_is_not_empty(result.inference_summary)
             _check_summary_is_not_empty(result.train_summary)
             self.assertTrue(Path(os.path.join(tmp_dir, "log.txt")).exists())
+
+
+class BenchmarkUtilsTest(unittest.TestCase):
+    @unittest.skipUnless(os.path.exists("/proc/self/clear_refs"), "resetting the peak memory requires Linux")
+    def test_measure_peak_memory_cpu_fast(self):
+        buffer_size = 256 * 2 ** 20
+
+        def allocate():
+            # bytes are written, so that the pages are resident
+            buffer = b"\x01" * buffer_size
+            del buffer
+
+        peak_memory = measure_peak_memory_cpu_fast(allocate)
+        # the peak of `allocate` would be reported again if the high-water mark was not reset
+        trivial_peak_memory = measure_peak_memory_cpu_fast(lambda: None)
+        self.assertLess(trivial_peak_memory, peak_memory)
+        self.assertGreater(peak_memory - trivial_peak_memory, buffer_size // 2)
+
+    def test_measure_peak_memory_cpu_fast_fallback(self):
+        function = lambda: None  # noqa: E731
+        with patch("transformers.benchmark.benchmark_utils.open", side_effect=OSError, create=True), patch(
+            "transformers.benchmark.benchmark_utils.measure_peak_memory_cpu", return_value=42
+        ) as mock_measure_peak_memory_cpu:
+            self.assertEqual(measure_peak_memory_cpu_fast(function), 42)
+        mock_measure_peak_memory_cpu.assert_called_once_with(function)